@@ -8,86 +8,113 @@ and verifies the server extracts and logs the filetype information.
 tail /tmp/lsp.log | grep -E '(Document opened|language|Using language filter)'
 """
 
-import json
+import os
+import shutil
 import subprocess
 import sys
-import time
+from concurrent.futures import ThreadPoolExecutor
 
+from _lsp_client import JSONDecodeError, dumps, enlarge_pipe, loads, write_frames
 
-def send_lsp_message(process, message):
-    """Send a JSON-RPC message to the LSP server."""
-    json_msg = json.dumps(message)
-    content_length = len(json_msg.encode('utf-8'))
-    header = f"Content-Length: {content_length}\r\n\r\n"
-    full_message = header + json_msg
+# Output lines queued by log() and written out together by flush_log()
+_log = []
+_LOG_BATCH = 32
 
-    print(f"→ {json_msg}")
-    process.stdin.write(full_message.encode('utf-8'))
-    process.stdin.flush()
+# Each language runs against its own server, logging to its own file; the
+# logs are joined into LOG_PATH afterwards in test order, then removed
+LOG_PATH = '/tmp/lsp.log'
+CASE_LOG_PATH = '/tmp/lsp-{language_id}.log'
 
 
-def read_lsp_response(process):
-    """Read a JSON-RPC response from the LSP server."""
-    # Read header
-    header_lines = []
-    while True:
-        line = process.stdout.readline().decode('utf-8')
-        if line == '\r\n':
-            break
-        header_lines.append(line.strip())
+def log(line=""):
+    """Queue a line of output, writing the batch once it is full."""
+    _log.append(line + "\n")
+    if len(_log) >= _LOG_BATCH:
+        flush_log()
 
-    # Parse content length
-    content_length = 0
-    for line in header_lines:
-        if line.startswith('Content-Length:'):
-            content_length = int(line.split(':')[1].strip())
-            break
 
-    if content_length == 0:
-        return None
+def flush_log():
+    """Write all queued output with a single call."""
+    if _log:
+        sys.stdout.write("".join(_log))
+        sys.stdout.flush()
+        _log.clear()
 
-    # Read content
-    content = process.stdout.read(content_length).decode('utf-8')
-    print(f"← {content}")
 
-    try:
-        return json.loads(content)
-    except json.JSONDecodeError:
-        return None
+def frame_lsp_message(message, echo=log):
+    """Serialize a JSON-RPC message into its LSP header and body buffers."""
+    body = dumps(message)
 
+    echo(f"→ {body.decode('utf-8')}")
+    return [b"Content-Length: %d\r\n\r\n" % len(body), body]
 
-def test_filetype_extraction():
-    """Test that the server extracts filetype from textDocument/didOpen."""
 
-    # Start LSP server with debug logging
-    print("Starting bkmr-lsp with debug logging...")
-    print("Check /tmp/lsp.log for detailed server logs\n")
+def send_lsp_message(process, message, echo=log):
+    """Send a JSON-RPC message to the LSP server."""
+    write_frames(process.stdin.fileno(), frame_lsp_message(message, echo))
 
-    try:
+
+def read_lsp_response(process, echo=log):
+    """Read the next JSON-RPC response, skipping server notifications."""
+    while True:
+        # Read header
+        header_lines = []
+        while True:
+            line = process.stdout.readline()
+            if line in (b'\r\n', b''):
+                break
+            header_lines.append(line)
+
+        # Parse content length straight from the bytes; nothing is decoded
+        # unless it is printed
+        content_length = 0
+        for line in header_lines:
+            if line.startswith(b'Content-Length:'):
+                content_length = int(line[15:])
+                break
+
+        if content_length == 0:
+            return None
+
+        # Read content
+        content = process.stdout.read(content_length)
+        echo(f"← {content.decode('utf-8', 'replace')}")
+
+        try:
+            message = loads(content)
+        except JSONDecodeError:
+            return None
+
+        # Notifications (e.g. window/logMessage) carry a method but no id
+        if 'method' not in message or 'id' in message:
+            return message
+
+
+def run_case(case):
+    """Open one document on a fresh server and request completion in it.
+
+    Returns (language_id, number of completion items, output lines).
+    """
+    language_id, uri, content = case
+    lines = []
+    echo = lines.append
+
+    with open(CASE_LOG_PATH.format(language_id=language_id), 'wb') as log_file:
+        # The server writes its log straight into the file
         process = subprocess.Popen(
             ['bkmr-lsp'],
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            stderr=log_file,
             env={'RUST_LOG': 'debug', 'PATH': 'target/debug'},
             text=False
         )
-    except FileNotFoundError:
-        print("❌ Error: bkmr-lsp binary not found.")
-        print("🔧 Solution: Run 'make install-debug' or 'cargo build' first.")
-        return False
 
-    # Redirect stderr to log file
-    with open('/tmp/lsp.log', 'w') as log_file:
-        stderr_process = subprocess.Popen(
-            ['tee', '/tmp/lsp.log'],
-            stdin=process.stderr,
-            stdout=log_file
-        )
+    # Room for the whole pipelined batch below in a single write
+    enlarge_pipe(process.stdin.fileno())
 
     try:
-        # Initialize
-        print("1. Initialize LSP server")
+        echo(f"\n{language_id}: initialize LSP server")
         init_msg = {
             "jsonrpc": "2.0",
             "id": 1,
@@ -97,32 +124,15 @@ def test_filetype_extraction():
                 "capabilities": {}
             }
         }
-        send_lsp_message(process, init_msg)
-        read_lsp_response(process)
-
-        # Send initialized
-        print("\n2. Send initialized notification")
-        initialized_msg = {
-            "jsonrpc": "2.0",
-            "method": "initialized",
-            "params": {}
-        }
-        send_lsp_message(process, initialized_msg)
-        time.sleep(0.1)  # Let server process
-
-        # Test different file types
-        test_files = [
-            ("rust", "file:///test/example.rs", "fn main() {\n    println!(\"Hello\");\n}"),
-            ("python", "file:///test/example.py", "#!/usr/bin/env python3\nprint('Hello')"),
-            ("javascript", "file:///test/example.js", "console.log('Hello');"),
-            ("go", "file:///test/example.go", "package main\n\nfunc main() {\n    println(\"Hello\")\n}"),
-            ("c", "file:///test/example.c", "#include <stdio.h>\n\nint main() {\n    printf(\"Hello\\n\");\n}")
-        ]
-
-        for i, (language_id, uri, content) in enumerate(test_files, 3):
-            print(f"\n{i}. Open {language_id} file")
-
-            did_open_msg = {
+        send_lsp_message(process, init_msg, echo)
+        read_lsp_response(process, echo)
+
+        # Frame the document session up front and send it in one write; the
+        # server handles it in order, so the completion sees the document
+        echo(f"{language_id}: open file, request completion, close")
+        messages = [
+            {"jsonrpc": "2.0", "method": "initialized", "params": {}},
+            {
                 "jsonrpc": "2.0",
                 "method": "textDocument/didOpen",
                 "params": {
@@ -133,65 +143,90 @@ def test_filetype_extraction():
                         "text": content
                     }
                 }
-            }
-            send_lsp_message(process, did_open_msg)
-            time.sleep(0.1)  # Let server process
-
-            # Test completion to trigger filetype usage
-            print(f"   Request completion for {language_id}")
-            completion_msg = {
+            },
+            {
                 "jsonrpc": "2.0",
-                "id": i,
+                "id": 2,
                 "method": "textDocument/completion",
                 "params": {
                     "textDocument": {"uri": uri},
                     "position": {"line": 0, "character": 5},
                     "context": {"triggerKind": 1}
                 }
-            }
-            send_lsp_message(process, completion_msg)
-            response = read_lsp_response(process)
-
-            # Close document
-            did_close_msg = {
+            },
+            {
                 "jsonrpc": "2.0",
                 "method": "textDocument/didClose",
                 "params": {
                     "textDocument": {"uri": uri}
                 }
-            }
-            send_lsp_message(process, did_close_msg)
-            time.sleep(0.1)
+            },
+        ]
+        write_frames(process.stdin.fileno(), [buffer for message in messages
+                               for buffer in frame_lsp_message(message, echo)])
 
-        # Shutdown
-        print(f"\n{len(test_files) + 3}. Shutdown server")
-        shutdown_msg = {
-            "jsonrpc": "2.0",
-            "id": 99,
-            "method": "shutdown",
-            "params": {}
-        }
-        send_lsp_message(process, shutdown_msg)
-        read_lsp_response(process)
+        response = read_lsp_response(process, echo) or {}
+        result = response.get('result') or []
+        items = result if isinstance(result, list) else result.get('items', [])
 
-        exit_msg = {
-            "jsonrpc": "2.0",
-            "method": "exit",
-            "params": {}
-        }
-        send_lsp_message(process, exit_msg)
+        # Requests run concurrently on the server, so shutdown waits for the
+        # completion reply; sent alongside it, it could be answered first
+        echo(f"{language_id}: shutdown")
+        send_lsp_message(process, {"jsonrpc": "2.0", "id": 99, "method": "shutdown", "params": {}}, echo)
+        read_lsp_response(process, echo)
 
-        return True
+        send_lsp_message(process, {"jsonrpc": "2.0", "method": "exit", "params": {}}, echo)
+        return language_id, len(items), lines
 
     finally:
         try:
             process.terminate()
-            stderr_process.terminate()
             process.wait(timeout=2)
-            stderr_process.wait(timeout=2)
         except:
             process.kill()
-            stderr_process.kill()
+
+
+def test_filetype_extraction():
+    """Test that the server extracts filetype from textDocument/didOpen."""
+
+    # Start LSP server with debug logging
+    print("Starting one bkmr-lsp per file type with debug logging...")
+    print(f"Check {LOG_PATH} for detailed server logs\n")
+
+    # Test different file types
+    test_files = [
+        ("rust", "file:///test/example.rs", "fn main() {\n    println!(\"Hello\");\n}"),
+        ("python", "file:///test/example.py", "#!/usr/bin/env python3\nprint('Hello')"),
+        ("javascript", "file:///test/example.js", "console.log('Hello');"),
+        ("go", "file:///test/example.go", "package main\n\nfunc main() {\n    println(\"Hello\")\n}"),
+        ("c", "file:///test/example.c", "#include <stdio.h>\n\nint main() {\n    printf(\"Hello\\n\");\n}")
+    ]
+
+    # The cases share nothing, so they run side by side
+    try:
+        with ThreadPoolExecutor(max_workers=len(test_files)) as executor:
+            results = list(executor.map(run_case, test_files))
+    except FileNotFoundError:
+        print("❌ Error: bkmr-lsp binary not found.")
+        print("🔧 Solution: Run 'make install-debug' or 'cargo build' first.")
+        return False
+
+    try:
+        for language_id, item_count, lines in results:
+            for line in lines:
+                log(line)
+            log(f"   {language_id}: {item_count} completion items")
+    finally:
+        flush_log()
+
+    with open(LOG_PATH, 'wb') as combined:
+        for language_id, _, _ in results:
+            case_log_path = CASE_LOG_PATH.format(language_id=language_id)
+            with open(case_log_path, 'rb') as case_log:
+                shutil.copyfileobj(case_log, combined)
+            os.remove(case_log_path)
+
+    return True
 
 
 def main():
@@ -18,6 +18,14 @@ Features:
 
 Usage:
     python3 scripts/lsp_debug_client.py <path-to-bkmr-lsp-binary>
+    LSP_DEBUG=1 python3 scripts/lsp_debug_client.py <path>   # log every message
+
+    Per-message and server stderr logging only happens with LSP_DEBUG=1, so
+    plain runs measure the protocol rather than the logging.
+
+    Uses orjson for (de)serialization when installed, stdlib json otherwise.
+    With msgspec installed, completion responses are decoded into just the
+    fields that are reported.
 
 Examples:
     python3 scripts/lsp_debug_client.py ~/bin/bkmr-lsp
@@ -25,8 +33,8 @@ Examples:
     python3 scripts/lsp_debug_client.py ./target/release/bkmr-lsp
 
 Output:
-    - Structured LSP message logging (requests and responses)
-    - Server stderr output with filtering
+    - Structured LSP message logging (requests and responses, LSP_DEBUG=1)
+    - Server stderr output with filtering (LSP_DEBUG=1)
     - Connection status and error diagnostics
     - Completion results analysis
     - Process management status
@@ -40,223 +48,11 @@ Use Cases:
 ============================================================================
 """
 
-import json
-import subprocess
+import os
 import sys
-import threading
-import time
-from typing import Dict, Any, Optional
-
-
-class LSPClient:
-    """Enhanced LSP client with comprehensive debugging and error handling."""
-    
-    def __init__(self, server_cmd: str):
-        print(f"🚀 Starting LSP server: {server_cmd}")
-
-        self.process = subprocess.Popen(
-            server_cmd,
-            shell=True,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            bufsize=0  # Unbuffered
-        )
-        self.request_id = 0
-
-        # Start stderr reader thread
-        self.stderr_thread = threading.Thread(target=self._read_stderr, daemon=True)
-        self.stderr_thread.start()
-
-        # Give server time to start
-        time.sleep(0.5)
-
-        # Validate server started successfully
-        if self.process.poll() is not None:
-            raise RuntimeError(f"❌ Server process exited immediately with code {self.process.returncode}")
-
-    def _read_stderr(self):
-        """Monitor and filter server stderr output in background thread."""
-        try:
-            for line in iter(self.process.stderr.readline, ''):
-                if line:
-                    # Filter important server messages
-                    line = line.rstrip()
-                    if any(keyword in line for keyword in ['ERROR', 'WARN', 'Successfully fetched', 'Executing bkmr']):
-                        print(f"🔍 [SERVER] {line}")
-                    elif 'DEBUG' in line and 'completion' in line.lower():
-                        print(f"📊 [DEBUG] {line}")
-        except Exception as e:
-            # Silent failure for stderr monitoring
-            pass
-
-    def send_message(self, message: Dict[str, Any]) -> None:
-        """Send a JSON-RPC message to the LSP server"""
-        json_str = json.dumps(message)
-        content = f"Content-Length: {len(json_str)}\r\n\r\n{json_str}"
-
-        print(f"📤 >>> SENDING LSP MESSAGE:")
-        print(f"    Content-Length: {len(json_str)}")
-        print(f"    Method: {message.get('method', 'N/A')}")
-        print(f"    ID: {message.get('id', 'N/A')}")
-        print(json.dumps(message, indent=2))
-        print()
-
-        try:
-            self.process.stdin.write(content)
-            self.process.stdin.flush()
-        except BrokenPipeError:
-            raise RuntimeError("❌ Server stdin pipe broken - server may have crashed")
-
-    def read_message(self, timeout: float = 5.0) -> Optional[Dict[str, Any]]:
-        """Read a JSON-RPC message from the LSP server with timeout"""
-        start_time = time.time()
-
-        try:
-            # Read Content-Length header with timeout
-            while True:
-                if time.time() - start_time > timeout:
-                    print(f"⏰ TIMEOUT: No response after {timeout} seconds")
-                    return None
-
-                # Check if process died
-                if self.process.poll() is not None:
-                    print(f"❌ ERROR: Server process died with exit code {self.process.returncode}")
-                    return None
-
-                line = self.process.stdout.readline()
-                if not line:
-                    time.sleep(0.1)
-                    continue
-
-                print(f"[DEBUG] Read header line: {repr(line)}")
+from itertools import islice
 
-                if line.startswith("Content-Length:"):
-                    content_length = int(line.split(":")[1].strip())
-                    print(f"[DEBUG] Content length: {content_length}")
-                    break
-
-            # Skip empty line
-            empty_line = self.process.stdout.readline()
-            print(f"[DEBUG] Empty line: {repr(empty_line)}")
-
-            # Read the JSON content
-            content = self.process.stdout.read(content_length)
-            print(f"[DEBUG] Raw content: {repr(content)}")
-
-            message = json.loads(content)
-
-            print(f"📥 <<< RECEIVED LSP MESSAGE:")
-            print(f"    Content-Length: {content_length}")
-            print(f"    Method: {message.get('method', 'N/A')}")
-            print(f"    ID: {message.get('id', 'N/A')}")
-            if 'error' in message:
-                print(f"    ❌ ERROR: {message.get('error', {})}")
-            print(json.dumps(message, indent=2))
-            print()
-
-            return message
-
-        except json.JSONDecodeError as e:
-            print(f"❌ JSON ERROR: Failed to decode server response: {e}")
-            print(f"    Raw content: {repr(content)}")
-            return None
-        except Exception as e:
-            print(f"❌ COMMUNICATION ERROR: {e}")
-            return None
-
-    def next_id(self) -> int:
-        self.request_id += 1
-        return self.request_id
-
-    def initialize(self) -> Optional[Dict[str, Any]]:
-        """Send initialize request"""
-        message = {
-            "jsonrpc": "2.0",
-            "id": self.next_id(),
-            "method": "initialize",
-            "params": {
-                "processId": None,
-                "clientInfo": {
-                    "name": "test-client",
-                    "version": "0.1.0"
-                },
-                "capabilities": {
-                    "textDocument": {
-                        "completion": {
-                            "completionItem": {
-                                "snippetSupport": True
-                            }
-                        }
-                    }
-                },
-                "workspaceFolders": None
-            }
-        }
-
-        self.send_message(message)
-        return self.read_message()
-
-    def initialized(self) -> None:
-        """Send initialized notification"""
-        message = {
-            "jsonrpc": "2.0",
-            "method": "initialized",
-            "params": {}
-        }
-        self.send_message(message)
-
-    def completion(self, uri: str = "file:///tmp/test.txt", line: int = 0, character: int = 1) -> Optional[
-        Dict[str, Any]]:
-        """Request completion"""
-        message = {
-            "jsonrpc": "2.0",
-            "id": self.next_id(),
-            "method": "textDocument/completion",
-            "params": {
-                "textDocument": {
-                    "uri": uri
-                },
-                "position": {
-                    "line": line,
-                    "character": character
-                },
-                "context": {
-                    "triggerKind": 1  # Invoked
-                }
-            }
-        }
-
-        self.send_message(message)
-        return self.read_message()
-
-    def shutdown(self) -> Optional[Dict[str, Any]]:
-        """Send shutdown request"""
-        message = {
-            "jsonrpc": "2.0",
-            "id": self.next_id(),
-            "method": "shutdown",
-            "params": None
-        }
-
-        self.send_message(message)
-        return self.read_message()
-
-    def exit(self) -> None:
-        """Send exit notification"""
-        message = {
-            "jsonrpc": "2.0",
-            "method": "exit",
-            "params": None
-        }
-        self.send_message(message)
-
-    def close(self):
-        """Close the LSP client"""
-        if self.process:
-            self.process.terminate()
-            self.process.wait()
+from _lsp_client import LSPClient
 
 
 def test_lsp_server(server_path: str):
@@ -270,16 +66,21 @@ def test_lsp_server(server_path: str):
     print("=" * 80)
     print()
 
+    print(f"🚀 Starting LSP server: {server_path}")
     try:
-        client = LSPClient(server_path)
-    except RuntimeError as e:
+        client = LSPClient([server_path])
+    except (RuntimeError, OSError) as e:
         print(f"Failed to start server: {e}")
         return
 
     try:
         # Step 1: Initialize
         print("=== 1. INITIALIZE ===")
-        init_response = client.initialize()
+        try:
+            init_response = client.initialize()
+        except RuntimeError as e:
+            print(f"Failed to start server: {e}")
+            return
         if not init_response:
             print("❌ FAILED: No initialize response received")
             return
@@ -292,34 +93,28 @@ def test_lsp_server(server_path: str):
             if capabilities:
                 print(f"    🛠️  Server capabilities: {list(capabilities.keys())}")
 
-        # Step 2: Initialized notification
-        print("\n=== 2. INITIALIZED NOTIFICATION ===")
-        client.initialized()
-        print("✅ Initialized notification sent")
-        time.sleep(1)  # Give server time to process
-
-        # Step 3: Test completion
-        print("\n=== 3. COMPLETION REQUEST ===")
-        completion_response = client.completion()
+        # Steps 2+3: Initialized notification and completion, pipelined in one write
+        print("\n=== 2. INITIALIZED NOTIFICATION + 3. COMPLETION REQUEST ===")
+        print("📤 Sending initialized notification with the completion request")
+        completion_response = client.initialized_and_completion()
         if completion_response:
             if 'error' in completion_response:
                 print(f"❌ COMPLETION ERROR: {completion_response['error']}")
             else:
                 result = completion_response.get("result")
                 if result:
-                    item_count = len(result) if isinstance(result, list) else len(result.get('items', []))
-                    print(f"✅ SUCCESS: Received {item_count} completion items")
-                    
-                    # Show first few items with details
                     items = result if isinstance(result, list) else result.get('items', [])
-                    for i, item in enumerate(items[:3]):
-                        label = item.get('label', 'No label')
-                        kind = item.get('kind', 'Unknown')
-                        detail = item.get('detail', '')
-                        print(f"    {i + 1}. {label} (kind: {kind}) {detail}")
-                    
+                    print(f"✅ SUCCESS: Received {len(items)} completion items")
+
+                    # Show first few items with details, emitted in a single write
+                    rows = [
+                        f"    {i}. {item.get('label', 'No label')} (kind: {item.get('kind', 'Unknown')}) "
+                        f"{item.get('detail', '')}\n"
+                        for i, item in enumerate(islice(items, 3), 1)
+                    ]
                     if len(items) > 3:
-                        print(f"    ... and {len(items) - 3} more items")
+                        rows.append(f"    ... and {len(items) - 3} more items\n")
+                    sys.stdout.write("".join(rows))
                 else:
                     print("⚠️  Empty completion result")
         else:
@@ -365,7 +160,6 @@ def main():
     server_path = sys.argv[1]
 
     # Verify server binary exists
-    import os
     if not os.path.exists(server_path):
         print(f"❌ ERROR: Server binary not found: {server_path}")
         print("")
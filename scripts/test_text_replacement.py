@@ -21,188 +21,149 @@ Expected Behavior:
     ❌ Should NOT use insertText for appending
 
 Usage:
-    python3 scripts/test_text_replacement.py <path-to-bkmr-lsp-binary>
+    python3 scripts/test_text_replacement.py <path-to-bkmr-lsp-binary> [query ...]
+
+    Each query word (default: md) is checked in turn against one server
+    process, which is started and initialized only once. Set LSP_DEBUG=1
+    to show the filtered server stderr and every LSP message.
 
 Example:
     python3 scripts/test_text_replacement.py ~/bin/bkmr-lsp
+    python3 scripts/test_text_replacement.py ~/bin/bkmr-lsp md sh py
 ============================================================================
 """
 
-import json
-import subprocess
 import sys
-import threading
-import time
+
+from _lsp_client import LSPClient
+
+def check_text_edit(response, query="md"):
+    """Verify the first completion item replaces the query word (e.g. "md", 0-2) via TextEdit"""
+    if not response or 'result' not in response:
+        print("❌ No completion response")
+        return False
+
+    result = response['result']
+    items = result if isinstance(result, list) else result.get('items', [])
+    
+    if not items:
+        print("❌ No completion items returned")
+        return False
+        
+    print(f"✅ Got {len(items)} completion items")
+    
+    # Check first item for TextEdit
+    first_item = items[0]
+    print(f"First item label: {first_item.get('label', 'N/A')}")
+    
+    if 'textEdit' in first_item:
+        text_edit = first_item['textEdit']
+        if isinstance(text_edit, dict) and 'range' in text_edit:
+            range_info = text_edit['range']
+            new_text = text_edit.get('newText', '')
+            print(f"✅ Found TextEdit:")
+            print(f"   Range: {range_info}")
+            print(f"   New text preview: {new_text[:50]}...")
+            
+            # Verify range replaces the query word
+            start = range_info['start']
+            end = range_info['end']
+            if start['line'] == 0 and start['character'] == 0 and end['character'] == len(query):
+                print(f"✅ Range correctly covers '{query}' word (0-{len(query)})")
+                return True
+            else:
+                print(f"❌ Range incorrect: expected 0-{len(query)}, got {start['character']}-{end['character']}")
+                return False
+        else:
+            print("❌ TextEdit format unexpected")
+            print(f"TextEdit: {text_edit}")
+            return False
+    else:
+        print("❌ No textEdit field found")
+        if 'insertText' in first_item:
+            print(f"   Found insertText instead: {first_item['insertText'][:50]}...")
+        print(f"   Item keys: {list(first_item.keys())}")
+        return False
 
 class SimpleTextEditTest:
+    """TextEdit checks sharing one server process through the shared LSPClient.
+
+    The server is initialized by the first check; later checks only reset
+    the test document, so spawn and initialize are paid once per run.
+    """
+
+    URI = "file:///tmp/test-textedit.txt"
+
     def __init__(self, server_cmd):
-        self.process = subprocess.Popen(
-            server_cmd,
-            shell=True,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            bufsize=0
-        )
-        self.request_id = 0
-        
-        # Start stderr reader
-        self.stderr_thread = threading.Thread(target=self._read_stderr, daemon=True)
-        self.stderr_thread.start()
-        time.sleep(0.5)
+        # Quiet unless LSP_DEBUG=1 asks for server logs and message dumps
+        self.client = LSPClient(server_cmd)
+        self._initialized = False
+        self._version = 0
 
-    def _read_stderr(self):
-        try:
-            for line in iter(self.process.stderr.readline, ''):
-                if line:
-                    print(f"[SERVER] {line.rstrip()}")
-        except:
-            pass
-
-    def send_message(self, message):
-        content = json.dumps(message)
-        lsp_message = f"Content-Length: {len(content)}\r\n\r\n{content}"
-        self.process.stdin.write(lsp_message)
-        self.process.stdin.flush()
-
-    def read_response(self):
+    def _initialize(self):
+        # The initialize reply doubles as the readiness signal
         try:
-            while True:
-                header_line = self.process.stdout.readline()
-                if not header_line or not header_line.startswith("Content-Length:"):
-                    continue
-                content_length = int(header_line.split(":")[1].strip())
-                self.process.stdout.readline()  # empty line
-                content = self.process.stdout.read(content_length)
-                response = json.loads(content)
-                if response.get("method") == "window/logMessage":
-                    continue
-                return response
-        except:
-            return None
-
-    def test_text_edit_completion(self):
-        print("🧪 Testing TextEdit completion replacement...")
-        
-        # Initialize
-        self.request_id += 1
-        init_msg = {
-            "jsonrpc": "2.0",
-            "id": self.request_id,
-            "method": "initialize",
-            "params": {
-                "processId": None,
-                "capabilities": {
-                    "textDocument": {
-                        "completion": {"completionItem": {"snippetSupport": True}}
-                    }
-                }
-            }
-        }
-        self.send_message(init_msg)
-        response = self.read_response()
+            response = self.client.initialize()
+        except RuntimeError:
+            response = None
         if not response:
             print("❌ Initialize failed")
             return False
         print("✅ Initialized")
+        self._initialized = True
+        return True
 
-        # Send initialized notification
-        self.send_message({"jsonrpc": "2.0", "method": "initialized", "params": {}})
-        time.sleep(0.1)
-
-        # Open document with query text
-        uri = "file:///tmp/test-textedit.txt"
-        content = "md"  # This should trigger completion for "md"
+    def test_text_edit_completion(self, query="md"):
+        print(f"🧪 Testing TextEdit completion replacement for '{query}'...")
         
-        self.send_message({
-            "jsonrpc": "2.0",
-            "method": "textDocument/didOpen",
-            "params": {
-                "textDocument": {
-                    "uri": uri,
-                    "languageId": "markdown",
-                    "version": 1,
-                    "text": content
-                }
-            }
-        })
-        time.sleep(0.1)
+        # initialize is answered first, since the server rejects requests
+        # until it has completed; the document reset and completion then go
+        # out in one write and the server handles them in order
+        if not self._initialized:
+            if not self._initialize():
+                return False
+            self.client.initialized()
 
-        # Request completion at position after "md" 
-        self.request_id += 1
-        completion_msg = {
+        # Reopen the document with just the query word, which should trigger
+        # completion for it, and request completion at the end of the word
+        self._version += 1
+        request_id = self.client.next_id()
+        self.client.restart_document(self.URI, "markdown", query, self._version, then=[{
             "jsonrpc": "2.0",
-            "id": self.request_id,
+            "id": request_id,
             "method": "textDocument/completion",
             "params": {
-                "textDocument": {"uri": uri},
-                "position": {"line": 0, "character": 2},  # After "md"
+                "textDocument": {"uri": self.URI},
+                "position": {"line": 0, "character": len(query)},
                 "context": {"triggerKind": 1}
             }
-        }
-        self.send_message(completion_msg)
+        }])
         
-        response = self.read_response()
-        if not response or 'result' not in response:
-            print("❌ No completion response")
-            return False
-
-        result = response['result']
-        items = result if isinstance(result, list) else result.get('items', [])
-        
-        if not items:
-            print("❌ No completion items returned")
-            return False
-            
-        print(f"✅ Got {len(items)} completion items")
-        
-        # Check first item for TextEdit
-        first_item = items[0]
-        print(f"First item label: {first_item.get('label', 'N/A')}")
-        
-        if 'textEdit' in first_item:
-            text_edit = first_item['textEdit']
-            if isinstance(text_edit, dict) and 'range' in text_edit:
-                range_info = text_edit['range']
-                new_text = text_edit.get('newText', '')
-                print(f"✅ Found TextEdit:")
-                print(f"   Range: {range_info}")
-                print(f"   New text preview: {new_text[:50]}...")
-                
-                # Verify range replaces the query word
-                start = range_info['start']
-                end = range_info['end']
-                if start['line'] == 0 and start['character'] == 0 and end['character'] == 2:
-                    print("✅ Range correctly covers 'md' word (0-2)")
-                    return True
-                else:
-                    print(f"❌ Range incorrect: expected 0-2, got {start['character']}-{end['character']}")
-                    return False
-            else:
-                print("❌ TextEdit format unexpected")
-                print(f"TextEdit: {text_edit}")
-                return False
-        else:
-            print("❌ No textEdit field found")
-            if 'insertText' in first_item:
-                print(f"   Found insertText instead: {first_item['insertText'][:50]}...")
-            print(f"   Item keys: {list(first_item.keys())}")
-            return False
+        # Full decode: the check needs each item's textEdit
+        response = self.client.read_response(request_id, timeout=10.0)
+        return check_text_edit(response, query)
 
     def close(self):
-        self.process.terminate()
-        self.process.wait()
+        self.client.close()
 
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: python3 test_text_edit.py <lsp-server-path>")
+    if len(sys.argv) < 2:
+        print("Usage: python3 test_text_replacement.py <lsp-server-path> [query ...]")
         sys.exit(1)
+    queries = sys.argv[2:] or ["md"]
     
-    test = SimpleTextEditTest(sys.argv[1])
     try:
-        success = test.test_text_edit_completion()
-        print(f"\n{'✅ PASS' if success else '❌ FAIL'}: TextEdit replacement test")
+        test = SimpleTextEditTest(sys.argv[1])
+    except OSError as e:
+        print(f"❌ Failed to start server: {e}")
+        return 1
+    try:
+        success = True
+        for query in queries:
+            if not test.test_text_edit_completion(query):
+                success = False
+            print()
+        print(f"{'✅ PASS' if success else '❌ FAIL'}: TextEdit replacement test")
         return 0 if success else 1
     finally:
         test.close()